@@ -31,13 +31,14 @@ import logging
 import os
 import pathlib
 import sys
+import threading
 import time
 import urllib.parse
 
-from google_auth_httplib2 import Request
-from httplib2 import Http
+import requests
 
 from google.auth.exceptions import RefreshError
+from google.auth.transport.requests import Request
 from google.oauth2 import service_account
 
 VERSION = "1"
@@ -67,8 +68,29 @@ SCOPES = [
     "https://www.googleapis.com/auth/gmail.insert",
     "https://www.googleapis.com/auth/gmail.labels"
 ]
+# Requests used to verify access to each API, as a mapping of API to
+# (API name, service name, URL). URLs are formatted with the admin's email.
+# APIs without an entry are not verified.
+API_PROBES = {
+    # Admin SDK does not have a corresponding service.
+    "admin.googleapis.com": (
+        "Admin SDK", None,
+        "https://content-admin.googleapis.com/admin/directory/v1/users/{email}?fields=isAdmin"),
+    "calendar-json.googleapis.com": (
+        "Calendar", "Calendar",
+        "https://www.googleapis.com/calendar/v3/users/me/calendarList?maxResults=1&fields=kind"),
+    # Contacts does not have a corresponding service.
+    "contacts.googleapis.com": (
+        "Contacts", None,
+        "https://www.google.com/m8/feeds/contacts/a.com/full/invalid_contact"),
+    "gmail.googleapis.com": (
+        "Gmail", "Gmail",
+        "https://gmail.googleapis.com/gmail/v1/users/me/labels?fields=labels.id")
+}
 DWD_URL_FORMAT = ("https://admin.google.com/ac/owl/domainwidedelegation?"
                   "overwriteClientId=true&clientIdToAdd={}&clientScopeToAdd={}")
+# SCOPES encoded for use as the clientScopeToAdd parameter of DWD_URL_FORMAT.
+ENCODED_SCOPES = urllib.parse.quote(",".join(SCOPES), safe="")
 USER_AGENT = f"{TOOL_NAME}_create_service_account_v{VERSION}"
 KEY_FILE = (f"{pathlib.Path.home()}/{TOOL_NAME.lower()}-service-account-key-"
             f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}.json")
@@ -76,13 +98,41 @@ KEY_FILE = (f"{pathlib.Path.home()}/{TOOL_NAME.lower()}-service-account-key-"
 # Zero width space character, to be used to separate URLs from punctuation.
 ZWSP = "\u200b"
 
+# Service account credentials loaded from KEY_FILE. Tokens are refreshed in
+# executor threads, so loading is guarded by a lock.
+_base_credentials = None
+_base_credentials_lock = threading.Lock()
+# Delegated credentials with their access tokens, keyed by (subject, scopes).
+_delegated_credentials_cache = {}
+# Session shared by all API and token requests so that connections are pooled.
+_session = requests.Session()
+_request = Request(_session)
+# Output of gcloud lookup commands, keyed by command.
+_command_output_cache = {}
+_command_output_locks = {}
+
 async def create_project():
   logging.info("Creating project...")
   project_id = f"{TOOL_NAME.lower()}-{int(time.time() * 1000)}"
   project_name = (f"{TOOL_NAME}-"
                   f"{datetime.datetime.now().strftime('%Y-%m-%d-%H-%M-%S')}")
-  await retryable_command(f"gcloud projects create {project_id} "
-                          f"--name {project_name} --set-as-default")
+  _, stderr, return_code = await retryable_command([
+      "gcloud", "projects", "create", project_id, "--name", project_name,
+      "--set-as-default"
+  ], suppress_errors=True)
+  if return_code:
+    # A previous attempt may have created the project before failing, in which
+    # case the retries fail because the project already exists.
+    _, _, describe_return_code = await retryable_command(
+        ["gcloud", "projects", "describe", project_id,
+         "--format=value(projectId)"],
+        max_num_retries=1,
+        suppress_errors=True)
+    if describe_return_code:
+      logging.critical("Failed to execute command: `%s`", stderr.decode())
+      sys.exit(return_code)
+    await retryable_command(
+        ["gcloud", "config", "set", "project", project_id])
   logging.info("%s successfully created \u2705", project_id)
 
 
@@ -90,7 +140,7 @@ async def verify_tos_accepted():
   logging.info("Verifying acceptance of Terms of service...")
   tos_accepted = False
   while APIS and not tos_accepted:
-    command = f"gcloud services enable {APIS[0]}"
+    command = ["gcloud", "services", "enable", APIS[0]]
     _, stderr, return_code = await retryable_command(
         command, max_num_retries=1, suppress_errors=True)
     if return_code:
@@ -123,8 +173,17 @@ async def verify_tos_accepted():
 async def enable_apis():
   logging.info("Enabling APIs...")
   # verify_tos_accepted checks the first API, so skip it here.
-  enable_api_calls = map(enable_api, APIS[1:])
-  await asyncio.gather(*enable_api_calls)
+  apis = APIS[1:]
+  if apis:
+    # gcloud accepts several APIs at once, which avoids starting a gcloud
+    # process per API. If the batch fails, then enable them one at a time.
+    command = ["gcloud", "services", "enable", *apis]
+    _, _, return_code = await retryable_command(
+        command, max_num_retries=1, suppress_errors=True)
+    if return_code:
+      logging.debug("Failed to enable APIs in a batch, enabling one by one")
+      enable_api_calls = map(enable_api, apis)
+      await asyncio.gather(*enable_api_calls)
   logging.info("APIs successfully enabled \u2705")
 
 
@@ -132,24 +191,38 @@ async def create_service_account():
   logging.info("Creating service account...")
   service_account_name = f"{TOOL_NAME.lower()}-service-account"
   service_account_display_name = f"{TOOL_NAME} Service Account"
-  await retryable_command(f"gcloud iam service-accounts create "
-                          f"{service_account_name} --display-name "
-                          f'"{service_account_display_name}"')
+  _, stderr, return_code = await retryable_command([
+      "gcloud", "iam", "service-accounts", "create", service_account_name,
+      "--display-name", service_account_display_name
+  ], suppress_errors=True)
+  if return_code:
+    # The service account may already exist, e.g. if a previous attempt created
+    # it before failing.
+    service_account_email, _, _ = await retryable_command(
+        ["gcloud", "iam", "service-accounts", "list",
+         f"--filter=email:{service_account_name}@*", "--format=value(email)"],
+        max_num_retries=1,
+        suppress_errors=True,
+        require_output=True)
+    if not service_account_email:
+      logging.critical("Failed to execute command: `%s`", stderr.decode())
+      sys.exit(return_code)
   logging.info("%s successfully created \u2705", service_account_name)
 
 
 async def create_service_account_key():
   logging.info("Creating service acount key...")
   service_account_email = await get_service_account_email()
-  await retryable_command(f"gcloud iam service-accounts keys create {KEY_FILE} "
-                          f"--iam-account={service_account_email}")
+  await retryable_command([
+      "gcloud", "iam", "service-accounts", "keys", "create", KEY_FILE,
+      f"--iam-account={service_account_email}"
+  ])
   logging.info("Service account key successfully created \u2705")
 
 
 async def authorize_service_account():
   service_account_id = await get_service_account_id()
-  scopes = urllib.parse.quote(",".join(SCOPES), safe="")
-  authorize_url = DWD_URL_FORMAT.format(service_account_id, scopes)
+  authorize_url = DWD_URL_FORMAT.format(service_account_id, ENCODED_SCOPES)
   input(f"\nBefore using {TOOL_NAME_FRIENDLY}, you must authorize the service "
         "account to perform actions on behalf of your users. You can do so by "
         f"clicking:\n\n{authorize_url}\n\nAfter clicking 'Authorize', return "
@@ -160,20 +233,22 @@ async def verify_service_account_authorization():
   logging.info("Verifying service account authorization...")
   admin_user_email = await get_admin_user_email()
   service_account_id = await get_service_account_id()
+  authorize_url = DWD_URL_FORMAT.format(service_account_id, ENCODED_SCOPES)
   scopes_are_authorized = False
   while not scopes_are_authorized:
-    scope_authorization_failures = []
-    for scope in SCOPES:
-      scope_authorized = verify_scope_authorization(admin_user_email, scope)
-      if not scope_authorized:
-        scope_authorization_failures.append(scope)
+    results = await asyncio.gather(
+        *(verify_scope_authorization(admin_user_email, scope)
+          for scope in SCOPES),
+        return_exceptions=True)
+    scope_authorization_failures = [
+        scope for scope, scope_authorized in zip(SCOPES, results)
+        if scope_authorized is not True
+    ]
     if scope_authorization_failures:
-      scopes = urllib.parse.quote(",".join(SCOPES), safe="")
-      authorize_url = DWD_URL_FORMAT.format(service_account_id, scopes)
       logging.info("The service account is not properly authorized.")
-      logging.warning("The following scopes are missing:")
-      for scope in scope_authorization_failures:
-        logging.warning("\t- %s", scope)
+      logging.warning(
+          "The following scopes are missing:\n%s",
+          "\n".join(f"\t- {scope}" for scope in scope_authorization_failures))
       print("\nTo fix this, please click the following link. After clicking "
             "'Authorize', return here to try again. If you are confident "
             "that these scopes have already been added, then you may continue "
@@ -184,7 +259,7 @@ async def verify_service_account_authorization():
       print(f"\n{authorize_url}\n")
       answer = input("Press Enter to try again, 'c' to continue, or 'n' to "
                      "cancel:")
-      if answer.lower == "c":
+      if answer.lower() == "c":
         scopes_are_authorized = True
       if answer.lower() == "n":
         sys.exit(0)
@@ -198,44 +273,19 @@ async def verify_api_access():
   admin_user_email = await get_admin_user_email()
   project_id = await get_project_id()
   token = get_access_token_for_scopes(admin_user_email, SCOPES)
+  probed_apis = [api for api in APIS if api in API_PROBES]
+  probe_urls = [
+      API_PROBES[api][2].format(email=admin_user_email) for api in probed_apis
+  ]
   retry_api_verification = True
   while retry_api_verification:
     disabled_apis = {}
     disabled_services = []
     retry_api_verification = False
-    for api in APIS:
-      api_name = service_name = ""
-      raw_api_response = ""
-      if api == "admin.googleapis.com":
-        # Admin SDK does not have a corresponding service.
-        api_name = "Admin SDK"
-        raw_api_response = execute_api_request(
-            f"https://content-admin.googleapis.com/admin/directory/v1/users/{admin_user_email}?fields=isAdmin",
-            token)
-      if api == "calendar-json.googleapis.com":
-        api_name = service_name = "Calendar"
-        raw_api_response = execute_api_request(
-            "https://www.googleapis.com/calendar/v3/users/me/calendarList?maxResults=1&fields=kind",
-            token)
-      if api == "contacts.googleapis.com":
-        # Contacts does not have a corresponding service.
-        api_name = "Contacts"
-        raw_api_response = execute_api_request(
-            "https://www.google.com/m8/feeds/contacts/a.com/full/invalid_contact",
-            token)
-      if api == "drive.googleapis.com":
-        api_name = service_name = "Drive"
-        raw_api_response = execute_api_request(
-            "https://www.googleapis.com/drive/v3/files?pageSize=1&fields=kind", token)
-      if api == "gmail.googleapis.com":
-        api_name = service_name = "Gmail"
-        raw_api_response = execute_api_request(
-            "https://gmail.googleapis.com/gmail/v1/users/me/labels?fields=labels.id", token)
-      if api == "tasks.googleapis.com":
-        api_name = service_name = "Tasks"
-        raw_api_response = execute_api_request(
-            "https://tasks.googleapis.com/tasks/v1/users/@me/lists?maxResults=1&fields=kind", token)
-
+    raw_api_responses = await asyncio.gather(
+        *(execute_api_request(url, token) for url in probe_urls))
+    for api, raw_api_response in zip(probed_apis, raw_api_responses):
+      api_name, service_name, _ = API_PROBES[api]
       if is_api_disabled(raw_api_response):
         disabled_apis[api_name] = api
         retry_api_verification = True
@@ -250,17 +300,18 @@ async def verify_api_access():
           "https://console.developers.google.com/apis/api/{}/overview?project={}"
           f"{ZWSP}."
       )
-      for api_name in disabled_apis:
-        api_id = disabled_apis[api_name]
-        print(disabled_api_message.format(api_name, api_id, project_id))
+      print("\n".join(
+          disabled_api_message.format(api_name, api_id, project_id)
+          for api_name, api_id in disabled_apis.items()))
       print("\nIf these APIs are already enabled, then you may need to wait "
             "for the changes to propagate. Propagation generally takes a few "
             "minutes. However, in rare cases, it can take up to 24 hours.\n")
 
     if not disabled_apis and disabled_services:
       disabled_service_message = "The {0} service is not enabled for {1}."
-      for service in disabled_services:
-        print(disabled_service_message.format(service, admin_user_email))
+      print("\n".join(
+          disabled_service_message.format(service, admin_user_email)
+          for service in disabled_services))
       print("\nIf this is expected, then please continue. If this is not "
             "expected, then please ensure that these services are enabled for "
             "your users by visiting "
@@ -278,25 +329,28 @@ async def verify_api_access():
 
 
 async def download_service_account_key():
-  command = f"cloudshell download {KEY_FILE}"
+  command = ["cloudshell", "download", KEY_FILE]
   await retryable_command(command)
 
 
 async def delete_key():
   input("\nPress Enter after you have downloaded the file.")
   logging.debug(f"Deleting key file ${KEY_FILE}...")
-  command = f"shred -u {KEY_FILE}"
+  command = ["shred", "-u", KEY_FILE]
   await retryable_command(command)  
 
 
 async def enable_api(api):
-  command = f"gcloud services enable {api}"
+  command = ["gcloud", "services", "enable", api]
   await retryable_command(command)
 
 
-def verify_scope_authorization(subject, scope):
+async def verify_scope_authorization(subject, scope):
   try:
-    get_access_token_for_scopes(subject, [scope])
+    # Refreshing the token blocks on network I/O, so run it in an executor to
+    # allow the scopes to be verified concurrently.
+    await asyncio.get_running_loop().run_in_executor(
+        None, get_access_token_for_scopes, subject, [scope])
     return True
   except RefreshError:
     logging.debug("Can't get token for scope %s", scope, exc_info=True)
@@ -307,27 +361,47 @@ def verify_scope_authorization(subject, scope):
     return False
 
 
+def get_base_credentials():
+  global _base_credentials
+  with _base_credentials_lock:
+    if _base_credentials is None:
+      _base_credentials = (
+          service_account.Credentials.from_service_account_file(KEY_FILE))
+  return _base_credentials
+
+
 def get_access_token_for_scopes(subject, scopes):
   logging.debug("Getting access token for scopes %s, user %s", scopes, subject)
-  credentials = service_account.Credentials.from_service_account_file(
-      KEY_FILE, scopes=scopes)
-  delegated_credentials = credentials.with_subject(subject)
-  request = Request(Http())
-  delegated_credentials.refresh(request)
+  cache_key = (subject, tuple(sorted(scopes)))
+  delegated_credentials = _delegated_credentials_cache.get(cache_key)
+  if delegated_credentials is None:
+    delegated_credentials = get_base_credentials().with_scopes(
+        scopes).with_subject(subject)
+  if delegated_credentials.valid:
+    logging.debug("Reusing cached access token")
+    return delegated_credentials.token
+  delegated_credentials.refresh(_request)
+  _delegated_credentials_cache[cache_key] = delegated_credentials
   logging.debug("Successfully obtained access token")
   return delegated_credentials.token
 
 
-def execute_api_request(url, token):
+async def execute_api_request(url, token):
+  return await asyncio.get_running_loop().run_in_executor(
+      None, _execute_api_request, url, token)
+
+
+def _execute_api_request(url, token):
   try:
-    http = Http()
+    # Google APIs only compress responses if the user agent contains "gzip".
     headers = {
+        "Accept-Encoding": "gzip",
         "Authorization": f"Bearer {token}",
         "Content-Type": "application/json",
-        "User-Agent": USER_AGENT
+        "User-Agent": f"{USER_AGENT} (gzip)"
     }
     logging.debug("Executing API request %s", url)
-    _, content = http.request(url, "GET", headers=headers)
+    content = _session.get(url, headers=headers, timeout=30).content
     logging.debug("Response: %s", content.decode())
     return content
   except:
@@ -351,21 +425,21 @@ def is_service_disabled(raw_api_response):
   if raw_api_response is None:
     return True
   try:
-    api_response = json.loads(raw_api_response)
-    error_reason = api_response["error"]["errors"][0]["reason"]
-    if "notACalendarUser" or "notFound" or "authError" in error_reason:
-      return True
+    error = json.loads(raw_api_response)["error"]
   except:
-    pass
+    return False
 
   try:
-    api_response = json.loads(raw_api_response)
-    if "service not enabled" in api_response["error"]["message"]:
+    error_reason = error["errors"][0]["reason"]
+    if error_reason in ("notACalendarUser", "notFound", "authError"):
       return True
   except:
     pass
 
-  return False
+  try:
+    return "service not enabled" in error["message"]
+  except:
+    return False
 
 
 async def retryable_command(command,
@@ -375,17 +449,22 @@ async def retryable_command(command,
                             require_output=False):
   num_tries = 1
   while num_tries <= max_num_retries:
-    logging.debug("Executing command (attempt %d): %s", num_tries, command)
-    process = await asyncio.create_subprocess_shell(
-        command,
-        stdout=asyncio.subprocess.PIPE,
+    logging.debug("Executing command (attempt %d): %s", num_tries,
+                  " ".join(command))
+    # Only capture stdout for callers that use it.
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdout=(asyncio.subprocess.PIPE
+                if require_output else asyncio.subprocess.DEVNULL),
         stderr=asyncio.subprocess.PIPE)
     stdout, stderr = await process.communicate()
     return_code = process.returncode
 
-    logging.debug("stdout: %s", stdout.decode())
-    logging.debug("stderr: %s", stderr.decode())
-    logging.debug("Return code: %d", return_code)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+      if stdout is not None:
+        logging.debug("stdout: %s", stdout.decode())
+      logging.debug("stderr: %s", stderr.decode())
+      logging.debug("Return code: %d", return_code)
 
     if return_code == 0:
       if not require_output or (require_output and stdout):
@@ -401,30 +480,39 @@ async def retryable_command(command,
       sys.exit(return_code)
 
 
+async def cached_command_output(command):
+  # The lock is created lazily so that it is bound to the running event loop.
+  key = tuple(command)
+  lock = _command_output_locks.setdefault(key, asyncio.Lock())
+  async with lock:
+    if key not in _command_output_cache:
+      output, _, _ = await retryable_command(command, require_output=True)
+      _command_output_cache[key] = output.decode().rstrip()
+  return _command_output_cache[key]
+
+
 async def get_project_id():
-  command = "gcloud config get-value project"
-  project_id, _, _ = await retryable_command(command, require_output=True)
-  return project_id.decode().rstrip()
+  command = ["gcloud", "config", "get-value", "project"]
+  return await cached_command_output(command)
 
 
 async def get_service_account_id():
-  command = 'gcloud iam service-accounts list --format="value(uniqueId)"'
-  service_account_id, _, _ = await retryable_command(
-      command, require_output=True)
-  return service_account_id.decode().rstrip()
+  command = [
+      "gcloud", "iam", "service-accounts", "list", "--format=value(uniqueId)"
+  ]
+  return await cached_command_output(command)
 
 
 async def get_service_account_email():
-  command = 'gcloud iam service-accounts list --format="value(email)"'
-  service_account_email, _, _ = await retryable_command(
-      command, require_output=True)
-  return service_account_email.decode().rstrip()
+  command = [
+      "gcloud", "iam", "service-accounts", "list", "--format=value(email)"
+  ]
+  return await cached_command_output(command)
 
 
 async def get_admin_user_email():
-  command = 'gcloud auth list --format="value(account)"'
-  admin_user_email, _, _ = await retryable_command(command, require_output=True)
-  return admin_user_email.decode().rstrip()
+  command = ["gcloud", "auth", "list", "--format=value(account)"]
+  return await cached_command_output(command)
 
 
 def init_logger():
@@ -462,8 +550,12 @@ async def main():
 
   await create_project()
   await verify_tos_accepted()
-  await enable_apis()
-  await create_service_account()
+  # Creating the service account only requires the project, so it can run
+  # while the APIs are being enabled. Both must finish before the service
+  # account is authorized.
+  enable_apis_task = asyncio.create_task(enable_apis())
+  create_service_account_task = asyncio.create_task(create_service_account())
+  await asyncio.gather(enable_apis_task, create_service_account_task)
   await authorize_service_account()
   await create_service_account_key()
   await verify_service_account_authorization()